@@ -31,6 +31,8 @@ class Arguments:
     remote_name: str
     method: str
     method_port: int
+    no_cache: bool
+    ldap_async: bool
     just_user: str
     just_user_file: str
     just_users: set = None
@@ -57,6 +59,8 @@ class Arguments:
         ldap = self.__parser.add_argument_group("LDAP")
         ldap.add_argument("-method-port", type=int, action="store", help="Change the default port for the -method option (Actually only apply to LDAP method).")
         ldap.add_argument("-simple-bind", action="store_true", help="Use simple bind to connect to the DC LDAP (Only using -method ldap option).")
+        ldap.add_argument("-ldap-async", action="store_true", help="Ask for the next LDAP page while the current one is parsed (Only using -method ldap option).")
+        ldap.add_argument("-no-cache", action="store_true", help="Don't read or write the cached root DSE of the DC (Only using -method ldap option).")
 
         # User
         filters = self.__parser.add_argument_group("Filters")
@@ -82,6 +86,8 @@ class Arguments:
         self.port           = self._args.port
         self.method         = self._args.method
         self.method_port    = self._args.method_port
+        self.no_cache       = self._args.no_cache
+        self.ldap_async     = self._args.ldap_async
         self.just_user      = self._args.just_user
         self.just_user_file = self._args.just_user_file
 
@@ -140,7 +146,7 @@ def main():
         users = samr.getAllUsers()
 
     elif arguments.method == "ldap":
-        ldap = LDAP(credentials, target, logger)
+        ldap = LDAP(credentials, target, logger, useCache=not arguments.no_cache, asyncSearch=arguments.ldap_async)
         users = ldap.getAllUsers()
 
     else:
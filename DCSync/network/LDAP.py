@@ -1,8 +1,14 @@
 
-from typing import List, AnyStr
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, AnyStr, Tuple
+
+from ldap3.protocol.rfc4512 import DsaInfo
 
 import ssl as tls
+import socket
 import ldap3
+import time
+import os
 
 from DCSync.structures.sAMAccountType import sAMAccountType
 from DCSync.structures.Credentials import Credentials
@@ -10,12 +16,37 @@ from DCSync.structures.Target import Target
 from DCSync.network.Kerberos import Kerberos
 from DCSync.core.Logger import Logger
 
+# Controls to get nTSecurityDescriptor from standard user
+# OWNER_SECURITY_INFORMATION + GROUP_SECURITY_INFORMATION + DACL_SECURITY_INFORMATION
+_SD_FLAGS_CONTROL_VALUE = bytes([48, 3, 2, 1, 7])
+_SD_FLAGS_CONTROL = ("1.2.840.113556.1.4.801", True, _SD_FLAGS_CONTROL_VALUE)
+
 class LDAP:
 
-    def __init__(self, credentials: Credentials, target: Target, logger: Logger) -> None:
+    # Seconds before giving up on a LDAPS / LDAP probe
+    PROBE_TIMEOUT = 3
+    # Entries per page when the whole result is read
+    PAGED_SIZE = 5000
+    # Entries per page at most when a limit is given, to stop early
+    LIMITED_PAGED_SIZE = 1000
+    # Root DSE of the DCs already reached, one file per DC
+    CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "dcsync")
+    # Seconds before a cached root DSE is read again from the DC
+    CACHE_MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, credentials: Credentials, target: Target, logger: Logger, useCache: bool = True, asyncSearch: bool = False) -> None:
         self.credentials    = credentials
         self.target         = target
         self.logger         = logger
+        self.useCache       = useCache
+        # ASYNC fetches the next page while the current one is parsed
+        self.clientStrategy = ldap3.ASYNC if asyncSearch else ldap3.SYNC
+
+        self.__ldapServer   = None
+        self.__ldapConn     = None
+        self.__bindError    = None
+        self.__dsaInfo      = self.__loadDsaInfo()
+        self.namingContexts = None
 
         self.__getPort()
         self.__checkAuthentication()
@@ -24,13 +55,27 @@ class LDAP:
         if self.target.method_port:
             return
 
-        self.target.method_port, self.target.tlsv1_2 = self.__tryLDAPS(tls.PROTOCOL_TLSv1_2, self.target.method_port)
+        # Probe both LDAPS versions at once, the results are then read by order of preference
+        executor = ThreadPoolExecutor(max_workers=2)
+
+        try:
+            tryTLSv1_2 = executor.submit(self.__tryLDAPS, tls.PROTOCOL_TLSv1_2, self.target.method_port)
+            tryTLSv1 = executor.submit(self.__tryLDAPS, tls.PROTOCOL_TLSv1, self.target.method_port)
+
+            self.target.method_port, self.target.tlsv1_2 = tryTLSv1_2.result()
 
-        if self.target.tlsv1_2 is None:
-            self.target.method_port, self.target.tlsv1 = self.__tryLDAPS(tls.PROTOCOL_TLSv1, self.target.method_port)
+            if self.target.tlsv1_2 is None:
+                self.target.method_port, self.target.tlsv1 = tryTLSv1.result()
+        finally:
+            # Don't wait for the TLSv1 handshake when TLSv1.2 already succeeded
+            executor.shutdown(wait=False, cancel_futures=True)
 
-            if self.target.tlsv1 is None:
-                self.target.method_port = self.__tryLDAP(self.target.method_port)
+        # LDAP sends an anonymous bind, only try it when LDAPS is not available
+        if self.target.tlsv1_2 is None and self.target.tlsv1 is None:
+            self.logger.debug("LDAPS failed, trying with LDAP.")
+            self.target.method_port, self.__ldapServer = self.__tryLDAP(self.target.method_port)
+
+        self.target.resolve_tls()
 
         if self.target.method_port is None:
             self.logger.error(f"Impossible to communicate with the target {self.target.remote} !")
@@ -38,18 +83,79 @@ class LDAP:
 
     def __checkAuthentication(self) -> None:
         self.logger.debug("Trying to connect to %s:%d" % (self.target.remote, self.target.method_port))
-        self.__Authentication()
+        self.__getConnection()
 
-        try:
-            self.getNamingContexts()
-        except IndexError:
+        if self.__bindError == "invalidCredentials":
             self.logger.error("Invalid credentials !")
             exit(1)
+        elif self.__bindError is not None:
+            self.logger.error(f"Authentication failed: {self.__bindError}")
+            exit(1)
+
+        self.getNamingContexts()
 
         self.logger.debug("Authentication success !")
 
-    def __Authentication(self) -> ldap3.Connection:
-        user = "%s\\%s" % (self.credentials.domain, self.credentials.username)
+    def __getCachePath(self) -> str:
+        return os.path.join(self.CACHE_DIRECTORY, "%s.json" % self.target.remote)
+
+    def __loadDsaInfo(self) -> DsaInfo:
+        if not self.useCache or not os.path.isfile(self.__getCachePath()):
+            return None
+
+        try:
+            if time.time() - os.path.getmtime(self.__getCachePath()) > self.CACHE_MAX_AGE:
+                self.logger.debug("Expired root DSE cache %s, ignoring it." % self.__getCachePath())
+                return None
+
+            dsaInfo = DsaInfo.from_file(self.__getCachePath())
+        except (OSError, ValueError, ldap3.core.exceptions.LDAPDefinitionError):
+            self.logger.debug("Invalid root DSE cache %s, ignoring it." % self.__getCachePath())
+            return None
+
+        if not self.__isDomainDsaInfo(dsaInfo):
+            self.logger.debug("Root DSE cache %s doesn't match the domain %s, ignoring it." % (self.__getCachePath(), self.credentials.domain))
+            return None
+
+        self.logger.debug("Using the root DSE cache %s" % self.__getCachePath())
+
+        return dsaInfo
+
+    def __isDomainDsaInfo(self, dsaInfo: DsaInfo) -> bool:
+        """
+        Check the cached default naming context against the FQDN of the domain, a NetBIOS name can't be checked.
+        """
+        if "." not in self.credentials.domain or not dsaInfo.naming_contexts:
+            return True
+
+        defaultNamingContext = ",".join("DC=%s" % component for component in self.credentials.domain.split("."))
+
+        return dsaInfo.naming_contexts[0].lower() == defaultNamingContext.lower()
+
+    def __saveDsaInfo(self) -> None:
+        try:
+            os.makedirs(self.CACHE_DIRECTORY, exist_ok=True)
+            self.__dsaInfo.to_file(self.__getCachePath())
+        except OSError:
+            self.logger.debug("Can't write the root DSE cache %s" % self.__getCachePath())
+
+    def __getConnection(self) -> ldap3.Connection:
+        """
+        Return the bound LDAP connection, authenticating only if needed.
+        """
+        if self.__ldapConn is None or not self.__ldapConn.bound:
+            self.__ldapConn = self.__Authentication()
+
+        return self.__ldapConn
+
+    def __getServer(self) -> ldap3.Server:
+        """
+        Reuse the Server of the LDAP probe or of a previous authentication when it matches the target.
+        """
+        ldapServer = self.__ldapServer
+
+        if ldapServer is not None and ldapServer.port == self.target.method_port and ldapServer.ssl == self.target.use_tls():
+            return ldapServer
 
         ldapTls = None
 
@@ -57,60 +163,86 @@ class LDAP:
             ldapTls = ldap3.Tls(validate=tls.CERT_NONE, version=tls.PROTOCOL_TLSv1_2, ciphers='ALL:@SECLEVEL=0')
         elif self.target.tlsv1:
             ldapTls = ldap3.Tls(validate=tls.CERT_NONE, version=tls.PROTOCOL_TLSv1, ciphers='ALL:@SECLEVEL=0')
-        
-        ldapServer = ldap3.Server(self.target.remote, use_ssl=self.target.use_tls(), port=self.target.method_port, get_info=ldap3.ALL, tls=ldapTls)
+
+        self.__ldapServer = ldap3.Server(self.target.remote, use_ssl=self.target.use_tls(), port=self.target.method_port, get_info=self.__getServerInfo(), tls=ldapTls)
+
+        return self.__ldapServer
+
+    def __getServerInfo(self) -> str:
+        # The root DSE is only read from the DC when it is not cached yet
+        return ldap3.NONE if self.__dsaInfo is not None else ldap3.DSA
+
+    def __Authentication(self) -> ldap3.Connection:
+        user = "%s\\%s" % (self.credentials.domain, self.credentials.username)
+
+        ldapServer = self.__getServer()
+
+        # Only raw attributes are read, skip the checks and conversions done by ldap3
+        connectionOptions = dict(client_strategy=self.clientStrategy, check_names=False, read_only=True, auto_range=False)
 
         if self.credentials.doKerberos:
-            ldapConn = ldap3.Connection(ldapServer)
+            ldapConn = ldap3.Connection(ldapServer, **connectionOptions)
             ldapConn = self.kerberosAuthentication(ldapConn)
+
+            # The SASL bind is done by hand, the root DSE isn't read by ldap3
+            if self.__dsaInfo is None:
+                ldapConn.refresh_server_info()
         elif self.credentials.doSimpleBind:
-            ldapConn = ldap3.Connection(ldapServer, user=user, password=self.credentials.getAuthenticationSecret(), authentication=ldap3.SIMPLE)
+            ldapConn = ldap3.Connection(ldapServer, user=user, password=self.credentials.getAuthenticationSecret(), authentication=ldap3.SIMPLE, **connectionOptions)
             ldapConn.bind()
         else:
-            ldapConn = ldap3.Connection(ldapServer, user=user, password=self.credentials.getAuthenticationSecret(), authentication=ldap3.NTLM)
+            ldapConn = ldap3.Connection(ldapServer, user=user, password=self.credentials.getAuthenticationSecret(), authentication=ldap3.NTLM, **connectionOptions)
             try:
                 ldapConn.bind()
-            except ldap3.core.exceptions.LDAPSocketReceiveError:
+            # Using the ASYNC strategy, the socket error surfaces as a lost session or a timeout
+            except (ldap3.core.exceptions.LDAPSocketReceiveError, ldap3.core.exceptions.LDAPSessionTerminatedByServerError, ldap3.core.exceptions.LDAPResponseTimeoutError):
                 self.logger.error("Can't connect using NTLM, try with -simple-bind option")
                 exit(1)
 
-        if ldapConn.result["description"] == "invalidCredentials":
-            self.logger.error("Invalid credentials !")
-            exit(1)
+        # The ASYNC strategy doesn't keep the bind result on the connection, last_error holds its description
+        self.__bindError = None if ldapConn.bound else (ldapConn.last_error or "unknown error")
+
+        if self.__dsaInfo is None and ldapServer.info is not None:
+            self.__dsaInfo = ldapServer.info
+
+            if self.useCache:
+                self.__saveDsaInfo()
 
         return ldapConn
 
-    def __tryLDAPS(self, proto: tls._SSLMethod, port: int) -> int:
+    def __tryLDAPS(self, proto: tls._SSLMethod, port: int) -> Tuple[int, bool]:
         port = port or 636
 
-        ldapTls = ldap3.Tls(validate=tls.CERT_NONE, version=proto, ciphers="ALL:@SECLEVEL=0")
-        ldapServer = ldap3.Server(self.target.remote, use_ssl=True, port=port, get_info=ldap3.ALL, tls=ldapTls)
-        ldapConn = ldap3.Connection(ldapServer)
-
+        # Only the TLS handshake matters here, no need for a LDAP bind
         try:
-            ldapConn.bind()
-        except ldap3.core.exceptions.LDAPSocketOpenError:
+            ctx = tls.SSLContext(proto)
+            ctx.verify_mode = tls.CERT_NONE
+            ctx.set_ciphers("ALL:@SECLEVEL=0")
+
+            with socket.create_connection((self.target.remote, port), timeout=self.PROBE_TIMEOUT) as sock:
+                with ctx.wrap_socket(sock) as tlsSock:
+                    tlsSock.do_handshake()
+        except (tls.SSLError, OSError):
             return None, None
-        except ldap3.core.exceptions.LDAPSocketReceiveError:
-            pass
 
         return port, True
 
-    def __tryLDAP(self, port: int) -> int:
-        self.logger.debug("LDAPS failed, trying with LDAP.")
+    def __tryLDAP(self, port: int) -> Tuple[int, ldap3.Server]:
         port = port or 389
 
-        ldapServer = ldap3.Server(self.target.remote, use_ssl=False, port=port, get_info=ldap3.ALL)
+        # Built like the authenticated Server so it can be reused if LDAP is chosen
+        ldapServer = ldap3.Server(self.target.remote, use_ssl=False, port=port, get_info=self.__getServerInfo(), connect_timeout=self.PROBE_TIMEOUT)
         ldapConn = ldap3.Connection(ldapServer)
 
         try:
-            ldapConn.bind()
+            # The root DSE is read by the authenticated bind
+            ldapConn.bind(read_server_info=False)
         except ldap3.core.exceptions.LDAPSocketOpenError:
-            return None
+            return None, None
         except ldap3.core.exceptions.LDAPSocketReceiveError:
-            return port
+            pass
 
-        return port
+        return port, ldapServer
 
     def kerberosAuthentication(self, ldapConn: ldap3.Connection) -> None:
         blob = Kerberos.kerberosLogin(self.target.remote, self.credentials.username, self.credentials.password,
@@ -127,6 +259,11 @@ class LDAP:
         ldapConn.sasl_in_progress = True
         response = ldapConn.post_send_single_response(ldapConn.send('bindRequest', request, None))
 
+        # The ASYNC strategy only returns the message id
+        if not ldapConn.strategy.sync:
+            responses, result = ldapConn.get_response(response)
+            response = responses + [result]
+
         ldapConn.sasl_in_progress = False
 
         if response[0]['result'] != 0:
@@ -136,72 +273,196 @@ class LDAP:
 
         return ldapConn
     
-    def search(self, dn: str, filter: str, scope: str, attributes: list = ["*"], cookie: str | bytes | None = None) -> list:
-        entries = list()
+    def search(self, dn: str, filter: str, scope: str, attributes: list = ["*"], extractor: Callable[[dict], Any] = None, includeSD: bool = False, pagedSize: int | None = None, limit: int | None = None) -> Iterator[Any]:
+        """
+        Yield the search entries page by page instead of holding the whole result.
+        When an extractor is given, only its result for each searchResEntry is yielded.
+        includeSD must be set to read the nTSecurityDescriptor attribute.
+        When a limit is given, only searchResEntry are yielded and the search is abandoned once limit of them are yielded.
+        """
+        if limit is not None and limit < 1:
+            return
+
+        controls = [_SD_FLAGS_CONTROL] if includeSD else list()
+        pagedSize = self.__getPagedSize(pagedSize, limit)
+
+        ldapConn = self.__getConnection()
+
+        request = self.__searchPage(ldapConn, dn, filter, scope, attributes, controls, None, pagedSize)
+
+        yield from self.__readPages(ldapConn, request, (dn, filter, scope, attributes), controls, pagedSize, extractor, limit)
+
+    def multiSearch(self, queries: Dict[str, Tuple[str, str, str, list]], extractor: Callable[[dict], Any] = None, includeSD: bool = False, pagedSize: int | None = None, limit: int | None = None) -> Dict[str, list]:
+        """
+        Run multiple (dn, filter, scope, attributes) searches on the same connection, the options are the ones of search.
+        The first page of every query is sent before waiting for any response, the results are returned by query name.
+        """
+        if limit is not None and limit < 1:
+            return {name: list() for name in queries}
+
+        controls = [_SD_FLAGS_CONTROL] if includeSD else list()
+        pagedSize = self.__getPagedSize(pagedSize, limit)
+
+        ldapConn = self.__getConnection()
+
+        requests = {name: self.__searchPage(ldapConn, *query, controls, None, pagedSize) for name, query in queries.items()}
+
+        return {name: list(self.__readPages(ldapConn, requests[name], queries[name], controls, pagedSize, extractor, limit)) for name in queries}
+
+    def __getPagedSize(self, pagedSize: int | None, limit: int | None) -> int:
+        if pagedSize is not None:
+            return pagedSize
+
+        if limit is not None:
+            return min(limit, self.LIMITED_PAGED_SIZE)
+
+        return self.PAGED_SIZE
+
+    def __readPages(self, ldapConn: ldap3.Connection, request: Any, query: Tuple[str, str, str, list], controls: list, pagedSize: int, extractor: Callable[[dict], Any], limit: int | None) -> Iterator[Any]:
+        """
+        Yield the entries of a paged search whose first page is already sent.
+        """
+        count = 0
+
+        while request is not None:
+            response, result = self.__getResponse(ldapConn, request)
+            cookie = self.__getCookie(result)
+
+            if extractor is not None:
+                # Skip what is not a response object
+                response = [extractor(entry) for entry in response if entry["type"] == "searchResEntry"]
+            elif limit is not None:
+                # Referrals are not entries, they must not count in the limit
+                response = [entry for entry in response if entry["type"] == "searchResEntry"]
+
+            request = None
+
+            if limit is not None and count + len(response) >= limit:
+                response = response[:limit - count]
+
+                # Let the DC release the paged search
+                if cookie:
+                    self.__getResponse(ldapConn, self.__searchPage(ldapConn, *query, controls, cookie, 0))
 
-        ldapConn = self.__Authentication()
-        ldapConn.search(
+                cookie = None
+
+            # Using the ASYNC strategy, the next page is fetched while this one is parsed
+            if cookie and not ldapConn.strategy.sync:
+                request = self.__searchPage(ldapConn, *query, controls, cookie, pagedSize)
+
+            count += len(response)
+            yield from response
+
+            # Using the SYNC strategy, the search blocks so the next page is only asked once this one is consumed
+            if cookie and ldapConn.strategy.sync:
+                # Drop every reference to this page, the connection keeps a copy of it, so it's freed before the next one is received
+                del response, result
+                ldapConn.response = None
+
+                request = self.__searchPage(ldapConn, *query, controls, cookie, pagedSize)
+
+    def __sendSearch(self, ldapConn: ldap3.Connection, **kwargs) -> Any:
+        """
+        Send a search, the returned request must be given to __getResponse.
+        """
+        request = ldapConn.search(**kwargs)
+
+        # The SYNC strategy already waited for the response, keep it before the next search
+        if ldapConn.strategy.sync:
+            return ldapConn.response, ldapConn.result
+
+        return request
+
+    def __searchPage(self, ldapConn: ldap3.Connection, dn: str, filter: str, scope: str, attributes: list, controls: list, cookie: bytes | None, pagedSize: int) -> Any:
+        return self.__sendSearch(
+            ldapConn,
             search_base=dn,
             search_filter=filter,
             search_scope=scope,
             attributes=attributes,
-            # Controls to get nTSecurityDescriptor from standard user
-            # OWNER_SECURITY_INFORMATION + GROUP_SECURITY_INFORMATION + DACL_SECURITY_INFORMATION
-            controls=[("1.2.840.113556.1.4.801", True, "%c%c%c%c%c" % (48, 3, 2, 1, 7), )],
-            paged_size=5000,
+            controls=controls,
+            paged_size=pagedSize,
             paged_cookie=cookie
         )
-        entries.extend(ldapConn.response)
 
-        if ldapConn.result.get("controls", False):
-            cookie = ldapConn.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-        else:
-            cookie = None
+    def __getResponse(self, ldapConn: ldap3.Connection, request: Any) -> Tuple[list, dict]:
+        """
+        Wait for the response of a search, request is its message id when using the ASYNC strategy.
+        """
+        if ldapConn.strategy.sync:
+            return request
+
+        try:
+            return ldapConn.get_response(request)
+        except (ldap3.core.exceptions.LDAPCommunicationError, ldap3.core.exceptions.LDAPResponseTimeoutError) as e:
+            self.logger.error(f"Lost the LDAP response from {self.target.remote} ({e}), try without -ldap-async option")
+            exit(1)
 
-        if cookie:
-            entries.extend(self.search(dn, filter, scope, attributes, cookie))
+    def __getCookie(self, result: dict) -> bytes | None:
+        if result.get("controls", False):
+            return result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
 
-        return entries
+        return None
+
+    def __searchBase(self, dn: str, filter: str, attributes: list) -> list:
+        """
+        Single entry search, paging is useless for a BASE scope.
+        """
+        ldapConn = self.__getConnection()
+        request = self.__sendSearch(
+            ldapConn,
+            search_base=dn,
+            search_filter=filter,
+            search_scope=ldap3.BASE,
+            attributes=attributes
+        )
 
-    def __getSAMAccountName(self, response: list) -> List[AnyStr]:
+        response, _ = self.__getResponse(ldapConn, request)
 
-        sAMAccountList = list()
+        return response
 
-        for entry in response:
-            # Not a response object
-            if entry["type"] != "searchResEntry":
-                continue
+    def getNamingContexts(self) -> list:
+        if self.namingContexts:
+            return self.namingContexts
 
-            sAMAccountList.append(
-                entry["raw_attributes"]["sAMAccountName"][0].decode()
+        if self.__dsaInfo is not None and self.__dsaInfo.naming_contexts:
+            self.namingContexts = self.__dsaInfo.naming_contexts
+        else:
+            response = self.__searchBase(
+                "",
+                "(objectClass=*)",
+                ["namingContexts"]
             )
 
-        return sAMAccountList
+            if not len(response):
+                self.logger.error(f"Impossible to read the naming contexts of {self.target.remote} !")
+                exit(1)
 
-    def getNamingContexts(self) -> list:
-        response = self.search(
-            "",
-            "(objectClass=*)",
-            ldap3.BASE,
-            ["namingContexts"]
-        )
+            self.namingContexts = [namingContext.decode("utf-8") for namingContext in response[0]["raw_attributes"]["namingContexts"]]
 
-        self.namingContexts = response[0]["attributes"]["namingContexts"]
         self.defaultNamingContext = self.namingContexts[0]
         self.configurationNamingContext = self.namingContexts[1]
         self.schemaNamingContext = self.namingContexts[2]
         self.domainDnsZonesNamingContext = self.namingContexts[3]
         self.forestDnsZonesNamingContext = self.namingContexts[4]
 
+        return self.namingContexts
+
     def getAllUsers(self) -> List[AnyStr]:
         """
         Use LDAP protocol to retrieve all principals (User / Group).
         """
-        response = self.search(
-            self.defaultNamingContext,
-            "(|(sAMAccountType=%d)(sAMAccountType=%d))" % (sAMAccountType.SAM_NORMAL_USER_ACCOUNT, sAMAccountType.SAM_MACHINE_ACCOUNT),
-            ldap3.SUBTREE,
-            ["sAMAccountName"]
+        results = self.multiSearch(
+            {
+                "principals": (
+                    self.defaultNamingContext,
+                    "(|(sAMAccountType=%d)(sAMAccountType=%d))" % (sAMAccountType.SAM_NORMAL_USER_ACCOUNT, sAMAccountType.SAM_MACHINE_ACCOUNT),
+                    ldap3.SUBTREE,
+                    ["sAMAccountName"]
+                )
+            },
+            lambda entry: entry["raw_attributes"]["sAMAccountName"][0].decode("utf-8")
         )
 
-        return self.__getSAMAccountName(response)
+        # DRSUAPI needs the count and index of the principals
+        return results["principals"]
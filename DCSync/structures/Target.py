@@ -1,13 +1,21 @@
 
 class Target:
 
-    tlsv1_2: bool = None
-    tlsv1: bool = None
+    __slots__ = ("remote", "port", "method_port", "tlsv1_2", "tlsv1", "_use_tls")
 
     def __init__(self, remote: str, port: int, method_port: int) -> None:
         self.remote = remote
         self.port = port
         self.method_port = method_port
+        self.tlsv1_2 = None
+        self.tlsv1 = None
+        self._use_tls = False
+
+    def resolve_tls(self) -> None:
+        """
+        Cache use_tls() once tlsv1_2 / tlsv1 are known, they don't change afterwards.
+        """
+        self._use_tls = self.tlsv1_2 is True or self.tlsv1 is True
 
     def use_tls(self) -> bool:
-        return self.tlsv1_2 or self.tlsv1
+        return self._use_tls